@@ -1,5 +1,6 @@
 import gradio as gr
 import sys, os, logging
+import logging.handlers
 from datetime import datetime
 
 # Import path
@@ -30,65 +31,105 @@ from crossbar_llm.langchain_llm_qa_trial import RunPipeline
 # Initialize logging
 current_date = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
 log_filename = f"query_log_{current_date}.log"
-log_handlers = [logging.FileHandler(log_filename)]
-logging.basicConfig(handlers=log_handlers, level=logging.INFO, 
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Buffer records in memory and write them to the file in batches; errors
+# are written out immediately. The file handler does the formatting, so it
+# needs its own formatter
+file_handler = logging.FileHandler(log_filename)
+file_handler.setFormatter(logging.Formatter(log_format))
+memory_handler = logging.handlers.MemoryHandler(capacity=512, flushLevel=logging.ERROR, target=file_handler)
+log_handlers = [memory_handler]
+logging.basicConfig(handlers=log_handlers, level=logging.INFO, format=log_format)
+# The format uses none of the thread, process or caller fields, so skip
+# collecting them for every record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging._srcfile = None
+
+
+def log_size() -> int:
+    # Write out buffered records first so the size covers everything logged so far
+    memory_handler.flush()
+    return os.path.getsize(log_filename)
+
+
+def read_log_since(offset: int) -> str:
+    # Only read what was logged after `offset` rather than the whole log,
+    # which keeps growing for the lifetime of the app
+    memory_handler.flush()
+    with open(log_filename, 'rb') as file:
+        file.seek(offset)
+        return file.read().decode()
+
 
 # Initialize the pipeline once
 rp = RunPipeline(verbose=False, model_name="gpt-3.5-turbo-instruct")  # Assuming default verbose is False
 
+# (llm_type, api_key) that rp's language model was last built with
+active_llm = {"key": None}
+
+
+def needs_llm_reset(llm_type, api_key) -> bool:
+    # Building the LLM client is only needed when the model or the key changes
+    return active_llm["key"] != (llm_type, api_key)
+
 
 def run_query(question: str, llm_type, api_key=None) -> str:
     logging.info("Processing question...")
 
     # Run the pipeline
     try:
-        response = rp.run_for_query(question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
+        response = rp.run_for_query(question, model_name=llm_type, reset_llm_type=needs_llm_reset(llm_type, api_key), api_key=api_key)
+        active_llm["key"] = (llm_type, api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
 
     return response
 
 
 def run_natural(query: str, question: str, llm_type, verbose_mode: bool, api_key=None) -> str:
+    log_offset = log_size() if verbose_mode else 0
     logging.info("Processing question...")
 
     # Run the pipeline
     try:
-        response, result = rp.execute_query(query=query, question=question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
+        response, result = rp.execute_query(query=query, question=question, model_name=llm_type, reset_llm_type=needs_llm_reset(llm_type, api_key), api_key=api_key)
+        active_llm["key"] = (llm_type, api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
     
     verbose_output = ""
     if verbose_mode:
-        with open(log_filename, 'r') as file:
-            verbose_output = file.read()
+        verbose_output = read_log_since(log_offset)
 
     return response, verbose_output, result
 
 def generate_and_run(question: str, llm_type, verbose_mode: bool, api_key=None) -> str:
+    log_offset = log_size() if verbose_mode else 0
     logging.info("Processing question...")
 
     # Run the pipeline
     try:
-        query = rp.run_for_query(question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
+        query = rp.run_for_query(question, model_name=llm_type, reset_llm_type=needs_llm_reset(llm_type, api_key), api_key=api_key)
+        active_llm["key"] = (llm_type, api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
 
     # Run the pipeline
     try:
-        response, result = rp.execute_query(query=query, question=question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
+        response, result = rp.execute_query(query=query, question=question, model_name=llm_type, reset_llm_type=needs_llm_reset(llm_type, api_key), api_key=api_key)
+        active_llm["key"] = (llm_type, api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
     
     verbose_output = ""
     if verbose_mode:
-        with open(log_filename, 'r') as file:
-            verbose_output = file.read()
+        verbose_output = read_log_since(log_offset)
 
     return response, verbose_output, result, query
 
@@ -130,5 +171,6 @@ with gr.Blocks(css=css) as interface:
     run_natural_button.click(run_natural, inputs=[query_textbox, question, natural_llm_type, verbose_mode, openai_api_key], outputs=[natural, verbose_output, query_output])
     generate_and_run_button.click(generate_and_run, inputs=[question, query_llm_type, verbose_mode, openai_api_key], outputs=[natural, verbose_output, query_output, query_textbox])
 
+interface.queue()
 interface.launch()
 
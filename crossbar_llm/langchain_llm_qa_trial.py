@@ -1,4 +1,5 @@
 import os, sys
+import asyncio
 import logging
 from dotenv import load_dotenv
 from datetime import datetime
@@ -20,8 +21,9 @@ from langchain_community.llms import Replicate
 
 # Import LLMChain for handling the sequence of language model operations
 from langchain.chains import LLMChain
+from langchain.prompts import PromptTemplate
 from crossbar_llm.neo4j_query_corrector import correct_query
-from crossbar_llm.qa_templates import CYPHER_GENERATION_PROMPT, CYPHER_OUTPUT_PARSER_PROMPT
+from crossbar_llm.qa_templates import CYPHER_OUTPUT_PARSER_PROMPT, build_cypher_generation_prompt
 
 from pydantic import BaseModel, validate_call
 
@@ -30,6 +32,8 @@ from typing import Literal, Union
 import pandas as pd
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 
 def configure_logging(verbose=False, log_filename="query_log.log"):
     log_handlers = [logging.FileHandler(log_filename)]
@@ -55,15 +59,21 @@ class Config(BaseModel):
     neo4j_password: str = os.getenv("NEO4J_PASSWORD")
     neo4j_db_name: str = os.getenv("NEO4J_DB_NAME")
     neo4j_uri: str = os.getenv("NEO4J_URI")
+    neo4j_max_connection_pool_size: int = int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", 100))
+    neo4j_connection_acquisition_timeout: float = float(os.getenv("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 60.0))
+    neo4j_max_transaction_retry_time: float = float(os.getenv("NEO4J_MAX_TRANSACTION_RETRY_TIME", 30.0))
 
 class Neo4JConnection:
     """
     Neo4JConnection class to handle interactions with a Neo4J database.
     It encapsulates the connection details and provides methods to interact with the database.
     """
-    def __init__(self, user: str, password: str, db_name: str, uri: str):
-        self.graph_helper = Neo4jGraphHelper(uri, user, password, db_name)
+    def __init__(self, user: str, password: str, db_name: str, uri: str, **driver_config):
+        self.graph_helper = Neo4jGraphHelper(uri, user, password, db_name, **driver_config)
         self.schema = self.graph_helper.create_graph_schema_variables()
+        # The schema does not change for the lifetime of the connection, so
+        # render it into the Cypher generation prompt only once
+        self.cypher_prompt = build_cypher_generation_prompt(self.schema)
 
     @validate_call
     def execute_query(self, query: str, top_k: int = 6) -> list:
@@ -73,6 +83,12 @@ class Neo4JConnection:
         """
         return self.graph_helper.execute(query, top_k)
 
+    async def execute_query_async(self, query: str, top_k: int = 6) -> list:
+        """
+        Async counterpart of `execute_query` for callers running in an event loop.
+        """
+        return await self.graph_helper.execute_async(query, top_k)
+
 class OpenAILanguageModel:
     """
     OpenAILanguageModel class for interacting with OpenAI's language models.
@@ -122,40 +138,145 @@ class ReplicateLanguageModel:
         self.model_name = model_name or "replicate-1.0"
         self.temperature = temperature or 0
         self.llm = Replicate(replicate_api_key=api_key, model_name=self.model_name, temperature=self.temperature)
+
+def llm_cache_key(llm) -> tuple:
+    """
+    Identifies the model behind a LangChain LLM wrapper for response caching.
+    """
+    return type(llm).__name__, getattr(llm, "model_name", None) or getattr(llm, "model", None)
+
 class QueryChain:
     """
     QueryChain class to handle the generation, correction, and parsing of Cypher queries using language models.
     It encapsulates the entire process as a single chain of operations.
     """
+    # Maximum number of responses kept in the cache, oldest are evicted first
+    cache_size = 256
+
     def __init__(self, 
                  cypher_llm: Union[OpenAILanguageModel, GoogleGenerativeLanguageModel, AnthropicLanguageModel, GroqLanguageModel, ReplicateLanguageModel],
                  qa_llm: Union[OpenAILanguageModel, GoogleGenerativeLanguageModel, AnthropicLanguageModel, GroqLanguageModel, ReplicateLanguageModel],
                  schema: dict, 
-                 verbose: bool = False):
-        self.cypher_chain = LLMChain(llm=cypher_llm, prompt=CYPHER_GENERATION_PROMPT, verbose = verbose)
+                 verbose: bool = False,
+                 cache: dict = None,
+                 cypher_prompt: PromptTemplate = None):
+        """
+        Args:
+            cache: LLM responses keyed by model and input, shared between chains
+                built for the same schema so repeated questions skip the LLM
+            cypher_prompt: Cypher generation prompt with `schema` already
+                rendered into it, built from `schema` when not given
+        """
+        if cypher_prompt is None:
+            cypher_prompt = build_cypher_generation_prompt(schema)
+        self.cypher_chain = LLMChain(llm=cypher_llm, prompt=cypher_prompt, verbose = verbose)
         self.qa_chain = LLMChain(llm=qa_llm, prompt=CYPHER_OUTPUT_PARSER_PROMPT, verbose = verbose)
         self.schema = schema
         self.verbose = verbose
+        self.cache = cache if cache is not None else {}
+        self.cypher_llm_key = llm_cache_key(cypher_llm)
+        self.qa_llm_key = llm_cache_key(qa_llm)
+
+    def _cache_put(self, key: tuple, value):
+        if len(self.cache) >= self.cache_size:
+            del self.cache[next(iter(self.cache))]
+        self.cache[key] = value
+
+    def _cypher_cache_key(self, question: str) -> tuple:
+        # Questions differing only in whitespace map to the same entry
+        return ("cypher", self.cypher_llm_key, " ".join(question.split()))
+
+    def _qa_cache_key(self, question: str, result: list) -> tuple:
+        return ("qa", self.qa_llm_key, " ".join(question.split()), repr(result))
+
+    def _correct_generated_query(self, key: tuple, generated_query: str) -> tuple[str, str]:
+        generated_query = generated_query.strip().strip("\n").replace("cypher","").strip("`")
+        corrected_query = correct_query(query=generated_query, edge_schema=self.schema["edges"])
+
+        # Queries the corrector rejected are not cached so that asking again
+        # gives the LLM another try
+        if corrected_query:
+            self._cache_put(key, (generated_query, corrected_query))
+        return generated_query, corrected_query
+
+    def _log_queries(self, generated_query: str, corrected_query: str):
+        # Logging generated and corrected queries
+        logger.info("Generated Query: %s", generated_query)
+        logger.info("Corrected Query: %s", corrected_query)
 
-    @validate_call
     def run_cypher_chain(self, question: str) -> str:
         """
         Executes the query chain: generates a query, corrects it, and returns the corrected query.
         """
-        self.generated_query = self.cypher_chain.run(node_types=self.schema["nodes"], 
-                                                node_properties=self.schema["node_properties"], 
-                                                edge_properties=self.schema["edge_properties"],
-                                                edges=self.schema["edges"], 
-                                                question=question).strip().strip("\n").replace("cypher","").strip("`")
-        
+        key = self._cypher_cache_key(question)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.generated_query, corrected_query = cached
+        else:
+            generated_query = self.cypher_chain.run(question=question)
+            self.generated_query, corrected_query = self._correct_generated_query(key, generated_query)
 
-        corrected_query = correct_query(query=self.generated_query, edge_schema=self.schema["edges"])
+        self._log_queries(self.generated_query, corrected_query)
 
-        # Logging generated and corrected queries
-        logging.info(f"Generated Query: {self.generated_query}")
-        logging.info(f"Corrected Query: {corrected_query}")
+        return corrected_query
+
+    async def agenerate_queries(self, question: str) -> tuple[str, str]:
+        """
+        Async counterpart of `run_cypher_chain`. Returns both the generated and
+        the corrected query instead of storing the former on the chain, so
+        that several questions can be in flight on the same chain.
+        """
+        key = self._cypher_cache_key(question)
+        cached = self.cache.get(key)
+        if cached is not None:
+            generated_query, corrected_query = cached
+        else:
+            generated_query = await self.cypher_chain.arun(question=question)
+            generated_query, corrected_query = self._correct_generated_query(key, generated_query)
 
+        self._log_queries(generated_query, corrected_query)
+
+        return generated_query, corrected_query
+
+    async def arun_cypher_chain(self, question: str) -> str:
+        """
+        Async counterpart of `run_cypher_chain`.
+        """
+        self.generated_query, corrected_query = await self.agenerate_queries(question)
         return corrected_query
+
+    def forget_query(self, question: str, corrected_query: str):
+        """
+        Drops `corrected_query` from the cache after it failed to run, so that
+        asking the question again gives the LLM another try.
+        """
+        question = " ".join(question.split())
+        stale_keys = [key for key, value in self.cache.items()
+                      if key[0] == "cypher" and key[2] == question and value[1] == corrected_query]
+        for key in stale_keys:
+            del self.cache[key]
+
+    def run_qa_chain(self, question: str, result: list) -> str:
+        """
+        Turns the query result into a natural language answer to the question.
+        """
+        key = self._qa_cache_key(question, result)
+        final_output = self.cache.get(key)
+        if final_output is None:
+            final_output = self.qa_chain.run(output=result, input_question=question).strip("\n")
+            self._cache_put(key, final_output)
+        return final_output
+
+    async def arun_qa_chain(self, question: str, result: list) -> str:
+        """
+        Async counterpart of `run_qa_chain`.
+        """
+        key = self._qa_cache_key(question, result)
+        final_output = self.cache.get(key)
+        if final_output is None:
+            final_output = (await self.qa_chain.arun(output=result, input_question=question)).strip("\n")
+            self._cache_put(key, final_output)
+        return final_output
     
 
 class RunPipeline:
@@ -171,7 +292,10 @@ class RunPipeline:
         self.neo4j_connection: Neo4JConnection = Neo4JConnection(self.config.neo4j_usr, 
                                                                  self.config.neo4j_password, 
                                                                  self.config.neo4j_db_name,
-                                                                 self.config.neo4j_uri)
+                                                                 self.config.neo4j_uri,
+                                                                 max_connection_pool_size=self.config.neo4j_max_connection_pool_size,
+                                                                 connection_acquisition_timeout=self.config.neo4j_connection_acquisition_timeout,
+                                                                 max_transaction_retry_time=self.config.neo4j_max_transaction_retry_time)
         
         # define llm type(s)
         self.define_llm(model_name)
@@ -179,6 +303,13 @@ class RunPipeline:
         # define outputs list
         self.outputs = []
 
+        # LLM responses shared by the query chains of this pipeline
+        self.response_cache = {}
+
+        # Query chain for the current language model(s), see get_query_chain
+        self.query_chain = None
+        self.query_chain_llm = None
+
     def define_llm(self, model_name):
 
         google_llm_models = [
@@ -257,6 +388,21 @@ class RunPipeline:
         else:
             raise ValueError("Unsupported Language Model Name")
         
+    def get_query_chain(self) -> QueryChain:
+        """
+        Returns the query chain for the current language model(s), building it
+        only when `define_llm` has replaced them since the last call.
+        """
+        if self.query_chain is None or self.query_chain_llm is not self.llm:
+            if isinstance(self.llm, dict):
+                cypher_llm, qa_llm = self.llm["cypher_llm"], self.llm["qa_llm"]
+            else:
+                cypher_llm = qa_llm = self.llm
+            self.query_chain = QueryChain(cypher_llm=cypher_llm, qa_llm=qa_llm, schema = self.neo4j_connection.schema,
+                                          cache = self.response_cache, cypher_prompt = self.neo4j_connection.cypher_prompt)
+            self.query_chain_llm = self.llm
+        return self.query_chain
+
     @validate_call
     def run_for_query(self, 
             question: str, 
@@ -277,22 +423,23 @@ class RunPipeline:
         if reset_llm_type:
             self.define_llm(model_name=model_name)   
 
-        logging.info(
-            f"Selected Language Model(s): {list(self.llm.values()) if isinstance(self.llm, dict) else self.llm}"
+        logger.info(
+            "Selected Language Model(s): %s", list(self.llm.values()) if isinstance(self.llm, dict) else self.llm
         )
-        logging.info(f"Question: {question}")
+        logger.info("Question: %s", question)
 
-        if isinstance(self.llm, dict):
-            query_chain: QueryChain = QueryChain(cypher_llm=self.llm["cypher_llm"], qa_llm=self.llm["qa_llm"], schema = self.neo4j_connection.schema)
-        else:
-            query_chain: QueryChain = QueryChain(cypher_llm=self.llm, qa_llm=self.llm, schema = self.neo4j_connection.schema)
+        query_chain: QueryChain = self.get_query_chain()
 
         corrected_query = query_chain.run_cypher_chain(question)
 
         return corrected_query
     
     def execute_query(self, query: str, question: str, model_name, reset_llm_type, api_key: str = None) -> str:
-        result = self.neo4j_connection.execute_query(query, top_k=self.top_k)
+        try:
+            result = self.neo4j_connection.execute_query(query, top_k=self.top_k)
+        except Exception:
+            self.get_query_chain().forget_query(question, query)
+            raise
 
         if api_key:
             self.config.openai_api_key = api_key
@@ -306,16 +453,13 @@ class RunPipeline:
         if reset_llm_type:
             self.define_llm(model_name=model_name)
 
-        logging.info(f"Query Result: {result}")
+        logger.info("Query Result: %s", result)
 
-        if isinstance(self.llm, dict):
-            query_chain: QueryChain = QueryChain(cypher_llm=self.llm["cypher_llm"], qa_llm=self.llm["qa_llm"], schema = self.neo4j_connection.schema)
-        else:
-            query_chain: QueryChain = QueryChain(cypher_llm=self.llm, qa_llm=self.llm, schema = self.neo4j_connection.schema)
+        query_chain: QueryChain = self.get_query_chain()
 
-        final_output = query_chain.qa_chain.run(output=result, input_question=question).strip("\n")
+        final_output = query_chain.run_qa_chain(question, result)
 
-        logging.info(f"{final_output}")
+        logger.info("%s", final_output)
 
         return final_output, result
         
@@ -329,15 +473,12 @@ class RunPipeline:
         if reset_llm_type:
             self.define_llm(model_name=model_name)
 
-        logging.info(
-            f"Selected Language Model(s): {list(self.llm.values()) if isinstance(self.llm, dict) else self.llm}"
+        logger.info(
+            "Selected Language Model(s): %s", list(self.llm.values()) if isinstance(self.llm, dict) else self.llm
         )
-        logging.info(f"Question: {question}")
+        logger.info("Question: %s", question)
 
-        if isinstance(self.llm, dict):
-            query_chain: QueryChain = QueryChain(cypher_llm=self.llm["cypher_llm"], qa_llm=self.llm["qa_llm"], schema = self.neo4j_connection.schema)
-        else:
-            query_chain: QueryChain = QueryChain(cypher_llm=self.llm, qa_llm=self.llm, schema = self.neo4j_connection.schema)
+        query_chain: QueryChain = self.get_query_chain()
 
         corrected_query = query_chain.run_cypher_chain(question)
 
@@ -347,15 +488,16 @@ class RunPipeline:
 
         try:
             result = self.neo4j_connection.execute_query(corrected_query, top_k=self.top_k)
-            logging.info(f"Query Result: {result}")
+            logger.info("Query Result: %s", result)
         except Exception as e:
-            logging.info(f"An error occurred trying to execute the query: {e}")
+            logger.info("An error occurred trying to execute the query: %s", e)
+            query_chain.forget_query(question, corrected_query)
             self.outputs.append((query_chain.generated_query, corrected_query, "", ""))
             return None
 
-        final_output = query_chain.qa_chain.run(output=result, input_question=question).strip("\n")
+        final_output = query_chain.run_qa_chain(question, result)
 
-        logging.info(f"{final_output}")
+        logger.info("%s", final_output)
 
         # add outputs of all steps to a list
         self.outputs.append((query_chain.generated_query, 
@@ -365,6 +507,85 @@ class RunPipeline:
         
         return final_output
     
+    async def _arun_question(self, query_chain: QueryChain, question: str) -> tuple[str, tuple]:
+        """
+        Runs a question end to end without raising on query errors.
+        Returns the final output and the row to add to `self.outputs`.
+        """
+        logger.info("Question: %s", question)
+
+        generated_query, corrected_query = await query_chain.agenerate_queries(question)
+
+        if not corrected_query:
+            return None, (generated_query, "", "", "")
+
+        try:
+            # The sync driver's connection pool is shared across threads, unlike
+            # an async driver, which would be bound to the running event loop
+            result = await asyncio.to_thread(self.neo4j_connection.execute_query, corrected_query, top_k=self.top_k)
+            logger.info("Query Result: %s", result)
+        except Exception as e:
+            logger.info("An error occurred trying to execute the query: %s", e)
+            query_chain.forget_query(question, corrected_query)
+            return None, (generated_query, corrected_query, "", "")
+
+        final_output = await query_chain.arun_qa_chain(question, result)
+
+        logger.info("%s", final_output)
+
+        return final_output, (generated_query, corrected_query, result, final_output)
+
+    async def arun_without_errors(self,
+                                  question: str, 
+                                  reset_llm_type: bool = False,
+                                  model_name: Union[str, list[str], dict[Literal["cypher_llm_model", "qa_llm_model"], str]] = None) -> str:
+        """
+        Async counterpart of `run_without_errors`.
+        """
+        if reset_llm_type:
+            self.define_llm(model_name=model_name)
+
+        logger.info(
+            "Selected Language Model(s): %s", list(self.llm.values()) if isinstance(self.llm, dict) else self.llm
+        )
+
+        query_chain: QueryChain = self.get_query_chain()
+
+        final_output, output = await self._arun_question(query_chain, question)
+        self.outputs.append(output)
+
+        return final_output
+
+    async def arun_batch(self, questions: list[str], max_concurrency: int = 8) -> list[str]:
+        """
+        Runs `run_without_errors` for all questions with their LLM and database
+        round-trips overlapping, at most `max_concurrency` questions at a time.
+        Outputs are added to `self.outputs` in the order of `questions`.
+        """
+        logger.info(
+            "Selected Language Model(s): %s", list(self.llm.values()) if isinstance(self.llm, dict) else self.llm
+        )
+
+        query_chain: QueryChain = self.get_query_chain()
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_question(question: str):
+            async with semaphore:
+                return await self._arun_question(query_chain, question)
+
+        results = await asyncio.gather(*(run_question(question) for question in questions))
+
+        self.outputs.extend(output for _, output in results)
+
+        return [final_output for final_output, _ in results]
+
+    def run_batch(self, questions: list[str], max_concurrency: int = 8) -> list[str]:
+        """
+        Synchronous wrapper of `arun_batch`.
+        """
+        return asyncio.run(self.arun_batch(questions, max_concurrency))
+
     def create_dataframe_from_outputs(self) -> pd.DataFrame:
         df = pd.DataFrame(self.outputs, columns=["Generated Query", "Corrected Query",
                                             "Query Result", "Natural Language Answer"])
@@ -384,7 +605,7 @@ def main():
     verbose_input = input("Enable verbose mode? (yes/no):\n").lower() == 'yes'
     configure_logging(verbose=verbose_input, log_filename=log_filename)
     
-    logging.info("Starting the pipeline...")
+    logger.info("Starting the pipeline...")
 
     try:
         pipeline = RunPipeline(verbose=verbose_input, model_name="gpt-3.5-turbo-instruct")
@@ -395,10 +616,10 @@ def main():
 
         print(final_output)
 
-        logging.info("Pipeline finished successfully.")
+        logger.info("Pipeline finished successfully.")
     
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logger.error("Error in pipeline: %s", e)
         raise e
     
 
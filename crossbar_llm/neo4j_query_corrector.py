@@ -1,10 +1,10 @@
 import re
-from collections import namedtuple
+import string
+import sys
+from functools import lru_cache
+from typing import NamedTuple
 
-from pydantic import validate_call
 
-
-@validate_call
 def extract_cypher(text: str) -> str:
     """Extract Cypher code from a text.
 
@@ -22,32 +22,34 @@ def extract_cypher(text: str) -> str:
 
     return matches[0] if matches else text
 
-Schema = namedtuple("Schema", ["left_node", "relation", "right_node"])
+class Schema(NamedTuple):
+    left_node: str
+    relation: str
+    right_node: str
+
+_SCHEMA_STRIP_CHARS = "()" + string.whitespace
+# Deletes the pattern punctuation around labels in "(:A)-[:R]->(:B)" edges
+_SANITIZE_TABLE = str.maketrans("", "", "():[]><")
 
-@validate_call
 def load_schemas(str_schemas: str) -> list[Schema]:
     """
     Args:
         str_schemas: string of schemas
     """
-    values = str_schemas.replace("(", "").replace(")", "").split(",")
-    schemas = []
-    for i in range(len(values)//3):
-        schemas.append(
-            Schema(
-                values[i*3].strip(), 
-                values[i*3+1].strip(), 
-                values[i*3+2].strip()
-            )
-        )
-    return schemas
+    # Labels come from a small fixed vocabulary, so intern them to let
+    # verify_schema's membership tests succeed on identity
+    values = (sys.intern(value.strip(_SCHEMA_STRIP_CHARS)) for value in str_schemas.split(","))
+    # zip over the same iterator groups the values three at a time
+    return [Schema(*triple) for triple in zip(values, values, values)]
 
 class QueryCorrector:
     
     property_pattern = re.compile(r"\{.+?\}")
     node_pattern = re.compile(r"\(.+?\)")
-    path_pattern = re.compile(r"(\([^\,\(\)]*?(\{.+\})?[^\,\(\)]*?\))(<?-)(\[.*?\])?(->?)(\([^\,\(\)]*?(\{.+\})?[^\,\(\)]*?\))")
-    node_relation_node_pattern = re.compile(r"(\()+(?P<left_node>[^()]*?)\)(?P<relation>.*?)\((?P<right_node>[^()]*?)(\))+")
+    # Property maps and relationship brackets may not contain another map or
+    # relationship (lists inside brackets aside), so that a hop cannot run on
+    # into the next pattern, e.g. across "}), (" between two matched nodes
+    path_pattern = re.compile(r"\((?P<left_node>[^\,\(\)]*?(\{[^{}]*\})?[^\,\(\)]*?)\)(?P<relation><?-(\[(?:[^\[\]]|\[[^\[\]]*\])*\])?->?)\((?P<right_node>[^\,\(\)]*?(\{[^{}]*\})?[^\,\(\)]*?)\)")
     relation_type_pattern = re.compile(r":(?P<relation_type>.+?)?(\{.+\})?]")
     
     def __init__(self, schemas: list[Schema]):
@@ -74,34 +76,33 @@ class QueryCorrector:
         Args:
             query: cypher query
         """
-        nodes = re.findall(self.node_pattern, query)
-        nodes = [self.clean_node(node) for node in nodes]
         res = {}
-        for node in nodes:
-            parts = node.split(":")
-            if parts == "":
+        # Drop property maps first, their values may contain parentheses
+        query = self.property_pattern.sub("", query)
+        for node in map(self.clean_node, self.node_pattern.findall(query)):
+            variable, sep, labels = node.partition(":")
+            if not variable and not sep:
                 continue
-            variable = parts[0]
-            if variable not in res:
-                res[variable] = []
-            res[variable] += parts[1:]
+            bucket = res.setdefault(variable, [])
+            if sep:
+                bucket.extend(labels.split(":"))
         return res
 
-    def extract_paths(self, query: str) -> 'list[str]':
+    def extract_paths(self, query: str) -> list[tuple[str, str, str]]:
         """
         Args:
             query: cypher query
+
+        Returns:
+            (left_node, relation, right_node) for every hop in the query, with
+            the node parentheses stripped
         """
         paths = []
         idx = 0
-        while matched := self.path_pattern.findall(query[idx:]):
-            matched = matched[0]
-            matched = [
-                m for i, m in enumerate(matched) if i not in [1, len(matched) - 1]
-            ]
-            path = "".join(matched)
-            idx = query.find(path) + len(path) - len(matched[-1])
-            paths.append(path)
+        while matched := self.path_pattern.search(query, idx):
+            paths.append(matched.group("left_node", "relation", "right_node"))
+            # The next hop starts from this hop's right node
+            idx = matched.start("right_node") - 1
         return paths
 
     def judge_direction(self, relation: str) -> str:
@@ -133,14 +134,12 @@ class QueryCorrector:
             str_node: node in string format
             node_variable_dict: dictionary of node variables
         """
-        splitted = str_node.split(":")
-        variable = splitted[0]
-        labels = []
+        variable, sep, rest = str_node.partition(":")
         if variable in node_variable_dict:
-            labels = node_variable_dict[variable]
-        elif variable == "" and len(splitted) > 1:
-            labels = splitted[1:]
-        return labels
+            return node_variable_dict[variable]
+        if not variable and sep:
+            return rest.split(":")
+        return []
     
     def verify_schema(self, from_node_labels: list[str], relation_types: list[str], to_node_labels: list[str]) -> bool:
         """
@@ -151,13 +150,13 @@ class QueryCorrector:
         """
         valid_schemas = self.schemas
         if from_node_labels != []:
-            from_node_labels = [label.strip('`') for label in from_node_labels]
+            from_node_labels = [sys.intern(label.strip('`')) for label in from_node_labels]
             valid_schemas = [schema for schema in valid_schemas if schema[0] in from_node_labels]
         if to_node_labels != []:
-            to_node_labels = [label.strip('`') for label in to_node_labels]
+            to_node_labels = [sys.intern(label.strip('`')) for label in to_node_labels]
             valid_schemas = [schema for schema in valid_schemas if schema[2] in to_node_labels]
         if relation_types != []:
-            relation_types = [type.strip('`') for type in relation_types]
+            relation_types = [sys.intern(type.strip('`')) for type in relation_types]
             valid_schemas = [schema for schema in valid_schemas if schema[1] in relation_types]
         return valid_schemas != []
     
@@ -180,53 +179,36 @@ class QueryCorrector:
             query: cypher query
         """
         node_variable_dict = self.detect_node_variables(query)
-        paths = self.extract_paths(query)
-        for path in paths:
-            original_path = path
-            start_idx = 0
-            while start_idx < len(path):
-                match_res = re.match(self.node_relation_node_pattern, path[start_idx:])
-                if match_res is None:
-                    break
-                start_idx += match_res.start()
-                match_dict = match_res.groupdict()
-                left_node_labels = self.detect_labels(match_dict["left_node"], node_variable_dict)
-                right_node_labels = self.detect_labels(match_dict["right_node"], node_variable_dict)
-                end_idx = start_idx + 4 + len(match_dict["left_node"]) + len(match_dict["relation"]) + len(match_dict["right_node"])
-                original_partial_path = original_path[start_idx:end_idx+1]
-                relation_direction, relation_types = self.detect_relation_types(match_dict["relation"])
-                
-                if relation_types != [] and ''.join(relation_types).find('*') != -1:
-                    start_idx += len(match_dict["left_node"]) + len(match_dict["relation"]) + 2
-                    continue
-                
-                if relation_direction == "OUTGOING":
-                    is_legal = self.verify_schema(left_node_labels, relation_types, right_node_labels)
-                    if not is_legal:
-                        is_legal = self.verify_schema(right_node_labels, relation_types, left_node_labels)
-                        if is_legal:
-                            corrected_relation = "<" + match_dict["relation"][:-1]
-                            corrected_partial_path = original_partial_path.replace(match_dict["relation"], corrected_relation)
-                            query = query.replace(original_partial_path, corrected_partial_path)
-                        else:
-                            return ""
-                elif relation_direction == "INCOMING":
-                    is_legal = self.verify_schema(right_node_labels, relation_types, left_node_labels)
-                    if not is_legal:
-                        is_legal = self.verify_schema(left_node_labels, relation_types, right_node_labels)
-                        if is_legal:
-                            corrected_relation = match_dict["relation"][1:] + ">"
-                            corrected_partial_path = original_partial_path.replace(match_dict["relation"], corrected_relation)
-                            query = query.replace(original_partial_path, corrected_partial_path)
-                        else:
-                            return ""
-                else:
-                    is_legal = self.verify_schema(left_node_labels, relation_types, right_node_labels)
-                    is_legal |= self.verify_schema(right_node_labels, relation_types, left_node_labels)
-                    if not is_legal:
+        for left_node, relation, right_node in self.extract_paths(query):
+            relation_direction, relation_types = self.detect_relation_types(relation)
+            
+            if relation_types != [] and ''.join(relation_types).find('*') != -1:
+                continue
+            
+            left_node_labels = self.detect_labels(left_node, node_variable_dict)
+            right_node_labels = self.detect_labels(right_node, node_variable_dict)
+            corrected_relation = None
+            if relation_direction == "OUTGOING":
+                if not self.verify_schema(left_node_labels, relation_types, right_node_labels):
+                    if self.verify_schema(right_node_labels, relation_types, left_node_labels):
+                        corrected_relation = "<" + relation[:-1]
+                    else:
+                        return ""
+            elif relation_direction == "INCOMING":
+                if not self.verify_schema(right_node_labels, relation_types, left_node_labels):
+                    if self.verify_schema(left_node_labels, relation_types, right_node_labels):
+                        corrected_relation = relation[1:] + ">"
+                    else:
                         return ""
-                
-                start_idx += len(match_dict["left_node"]) + len(match_dict["relation"]) + 2
+            elif not (self.verify_schema(left_node_labels, relation_types, right_node_labels)
+                      or self.verify_schema(right_node_labels, relation_types, left_node_labels)):
+                return ""
+
+            # Only rebuild the path text when there is something to fix
+            if corrected_relation is not None:
+                original_path = "(" + left_node + ")" + relation + "(" + right_node + ")"
+                corrected_path = original_path.replace(relation, corrected_relation)
+                query = query.replace(original_path, corrected_path)
         return query
     
     def __call__(self, query: str) -> str:
@@ -238,23 +220,36 @@ class QueryCorrector:
 
 
 # PREPARE EDGE SCHEMA
-@validate_call
-def correct_query(query: str, edge_schema: list) -> str:
-    query = extract_cypher(query.strip("\n"))
-
-    str_schemas = ""
-    to_be_replaced = ["(", ")", ":", "[", "]", ">", "<"]
+@lru_cache(maxsize=8)
+def _build_corrector(edge_schema: tuple[str, ...]) -> QueryCorrector:
+    """
+    Args:
+        edge_schema: edges in "(:A)-[:R]->(:B)" format, as a tuple so that
+            the corrector built for a schema can be reused across queries
+    """
+    str_schemas = []
     for e in edge_schema:
         splitted = e.strip().split("-")
-        splitted_corrected = []
-        for s in splitted:
-            for t in to_be_replaced:
-                s = s.replace(t, "")
-            splitted_corrected.append(s)
+        splitted_corrected = [s.translate(_SANITIZE_TABLE) for s in splitted]
+
+        str_schemas.append("(" + ", ".join(splitted_corrected) + ")")
+
+    schemas = load_schemas(", ".join(str_schemas))
+    return QueryCorrector(schemas)
 
-        add =", ("+", ".join(splitted_corrected)+")"
-        str_schemas += add
 
-    schemas = load_schemas(str_schemas.strip(",").strip())
-    query_corrector = QueryCorrector(schemas)
+def correct_query(query: str, edge_schema: list) -> str:
+    # Called for every generated query, so only check the types instead of
+    # having pydantic validate (and copy) the whole edge schema each time
+    if not (isinstance(query, str) and isinstance(edge_schema, list)):
+        raise TypeError("query must be a str and edge_schema a list")
+    query = extract_cypher(query.strip("\n"))
+    query_corrector = _build_corrector(tuple(edge_schema))
     return query_corrector(query)
+
+
+def correct_queries(queries: list[str], edge_schema: list) -> list[str]:
+    if not (isinstance(queries, list) and isinstance(edge_schema, list)):
+        raise TypeError("queries and edge_schema must be lists")
+    query_corrector = _build_corrector(tuple(edge_schema))
+    return [query_corrector(extract_cypher(query.strip("\n"))) for query in queries]
@@ -1,106 +1,215 @@
 import neo4j
+import logging
 import os
 import json
 import re
+from functools import lru_cache
 
-from pydantic import validate_call
 from crossbar_llm.utils import timer_func
 
-node_properties_query = """
-CALL apoc.meta.data()
-YIELD label, other, elementType, type, property
-WHERE NOT type = "RELATIONSHIP" AND elementType = "node"
-WITH label AS nodeLabels, collect({property:property, type:type}) AS properties
-RETURN {labels: nodeLabels, properties: properties} AS output
-"""
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-rel_properties_query = """
+# apoc.meta.data() samples the whole graph, so call it once and derive the
+# node properties, relationship properties and relationship patterns from
+# the same rows
+schema_query = """
 CALL apoc.meta.data()
 YIELD label, other, elementType, type, property
-WHERE NOT type = "RELATIONSHIP" AND elementType = "relationship"
-WITH label AS nodeLabels, collect({property:property, type:type}) AS properties
-RETURN {type: nodeLabels, properties: properties} AS output
+WITH collect({label: label, other: other, elementType: elementType, type: type, property: property}) AS meta
+CALL {
+    WITH meta
+    UNWIND meta AS m
+    WITH m WHERE NOT m.type = "RELATIONSHIP" AND m.elementType = "node" AND m.property <> "preferred_id"
+    WITH m.label AS nodeLabels, collect({property:m.property, type:m.type}) AS properties
+    RETURN collect({labels: nodeLabels, properties: properties}) AS node_properties
+}
+CALL {
+    WITH meta
+    UNWIND meta AS m
+    WITH m WHERE NOT m.type = "RELATIONSHIP" AND m.elementType = "relationship"
+    WITH m.label AS nodeLabels, collect({property:m.property, type:m.type}) AS properties
+    RETURN collect({type: nodeLabels, properties: properties}) AS edge_properties
+}
+CALL {
+    WITH meta
+    UNWIND meta AS m
+    WITH m WHERE m.type = "RELATIONSHIP" AND m.elementType = "node"
+    UNWIND m.other AS other_node
+    RETURN collect("(:" + m.label + ")-[:" + m.property + "]->(:" + toString(other_node) + ")") AS edges
+}
+RETURN node_properties, edge_properties, edges
 """
 
-rel_query = """
-CALL apoc.meta.data()
-YIELD label, other, elementType, type, property
-WHERE type = "RELATIONSHIP" AND elementType = "node"
-UNWIND other AS other_node
-RETURN "(:" + label + ")-[:" + property + "]->(:" + toString(other_node) + ")" AS output
-"""
+selected_nodes = ["SideEffect", "EcNumber", "Phenotype", "Pathway", "MolecularMixture", "SmallMolecule",
+                  "MolecularFunction", "BiologicalProcess", "CellularComponent", "Gene", "Protein",
+                  "Disease", "OrganismTaxon", "ProteinDomain"]
+selected_node_set = frozenset(selected_nodes)
+
+# Deletes the pattern punctuation around labels in "(:A)-[:R]->(:B)" edges
+edge_sanitize_table = str.maketrans("", "", "():[]><")
+
+limit_pattern = re.compile(r"\bLIMIT\s+\d+\b", re.IGNORECASE)
+# LIMIT as a keyword, not as part of a word or a property such as p.limit
+limit_keyword_pattern = re.compile(r"(?<![\w.])LIMIT\b", re.IGNORECASE)
+
+@lru_cache(maxsize=4)
+def _load_schema(file_path: str, mtime_ns: int) -> dict:
+    # Keyed on the modification time so a rewritten file is read again
+    with open(file_path, "rb") as fp:
+        data = fp.read()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _dump_schema(schema: dict, file_path: str):
+    data = orjson.dumps(schema) if orjson is not None else json.dumps(schema).encode()
+    # Write next to the target and move it into place, so that a crash
+    # mid-write never leaves a truncated schema file behind
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 class Neo4jGraphHelper:
-    def __init__(self, URI: str, user: str, password: str, db_name: str):
+    def __init__(self, URI: str, user: str, password: str, db_name: str,
+                 max_connection_pool_size: int = 100,
+                 connection_acquisition_timeout: float = 60.0,
+                 max_transaction_retry_time: float = 30.0):
+        """
+        Args:
+            URI: Neo4j connection URI
+            user: database user
+            password: database password
+            db_name: database to run all queries against
+            max_connection_pool_size: maximum number of pooled connections
+            connection_acquisition_timeout: seconds to wait for a free pooled connection
+            max_transaction_retry_time: seconds to keep retrying transient failures
+        """
         self.URI = URI
         self.AUTH = (user, password)
         self.db_name = db_name
+        self._driver_config = {
+            "auth": self.AUTH,
+            "max_connection_pool_size": max_connection_pool_size,
+            "connection_acquisition_timeout": connection_acquisition_timeout,
+            "max_transaction_retry_time": max_transaction_retry_time,
+        }
+        # Drivers own a connection pool, so share one across all calls
+        self._driver = neo4j.GraphDatabase.driver(self.URI, **self._driver_config)
+        # Open the first connection now rather than on the first user query,
+        # which also surfaces a wrong URI or credentials at startup
+        try:
+            self._driver.verify_connectivity()
+        except Exception as e:
+            logging.error("Could not connect to Neo4j at %s: %s", self.URI, e)
+            self._driver.close()
+            raise
+        # Sessions always target an explicit database, which spares the driver
+        # a home database lookup, and are read-only so they route to readers
+        self._read_session_config = {"database": self.db_name, "default_access_mode": neo4j.READ_ACCESS}
+        # Async drivers are bound to the event loop they first run on, so this
+        # one is created lazily by execute_async
+        self._async_driver = None
+        self._schema_cache = None
+
+    def close(self):
+        self._driver.close()
+
+    async def close_async(self):
+        if self._async_driver is not None:
+            await self._async_driver.close()
+            self._async_driver = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @timer_func
     def create_graph_schema_variables(self):
+        if self._schema_cache is None:
+            self._schema_cache = self._fetch_graph_schema()
+        return self._schema_cache
+
+    def _fetch_graph_schema(self):
         file_path = os.path.join(os.getcwd(), "graph_schema.json")
-        if os.path.isfile(file_path):
-            with open(file_path, "r") as fp:
-                return json.load(fp)
+        try:
+            mtime_ns = os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            pass
         else:
-            with neo4j.GraphDatabase.driver(self.URI, auth=self.AUTH) as driver:
-                # Node property filtering
-                records, _, _ = driver.execute_query(node_properties_query, database_=self.db_name)
-                node_results = [res["output"] for res in records]
-
-                selected_nodes = ["SideEffect", "EcNumber", "Phenotype", "Pathway", "MolecularMixture", "SmallMolecule", 
-                                "MolecularFunction", "BiologicalProcess", "CellularComponent", "Gene", "Protein", 
-                                "Disease", "OrganismTaxon", "ProteinDomain"]
-
-                for n in node_results:
-                    n["properties"] = [prop for prop in n["properties"] if prop["property"] != "preferred_id"]
-
-                node_results_filtered = [n for n in node_results if n["labels"] in selected_nodes]
-
-                # Relation type filtering
-                records, _, _ = driver.execute_query(rel_query, database_=self.db_name)
-                edge_results_filtered = []
-                to_be_replaced = ["(", ")", ":", "[", "]", ">", "<"]
-                for res in records:        
-                    splitted = res.values()[0].split("-")
-                    splitted_corrected = []
-                    for i in splitted:
-                        for j in to_be_replaced:
-                            i = i.replace(j, "")
-                        splitted_corrected.append(i)
+            return _load_schema(file_path, mtime_ns)
+
+        records, _, _ = self._driver.execute_query(schema_query, database_=self.db_name, routing_="r")
+        meta = records[0]
+
+        # Node property filtering
+        node_results_filtered = [n for n in meta["node_properties"] if n["labels"] in selected_node_set]
+
+        # Relation type filtering
+        edge_results_filtered = []
+        for edge in meta["edges"]:
+            splitted = edge.split("-")
+            splitted_corrected = [i.translate(edge_sanitize_table) for i in splitted]
+
+            if splitted_corrected[0] in selected_node_set and splitted_corrected[2] in selected_node_set:
+                edge_results_filtered.append(edge)
+
+        # Relation property filtering
+        edge_properties_results_filtered = meta["edge_properties"]
+
+        schema = {
+            "nodes": list(selected_nodes),
+            "node_properties": node_results_filtered,
+            "edges": edge_results_filtered,
+            "edge_properties": edge_properties_results_filtered
+        }
+
+        _dump_schema(schema, file_path)
+
+        return schema
+
+    def _limit_query(self, query: str) -> str:
+        if not isinstance(query, str):
+            raise TypeError(f"query must be a str, not {type(query).__name__}")
+        query = query.strip()
+        if not query:
+            # The corrector returns "" for queries it cannot fix; reject them
+            # here instead of paying a round-trip for a syntax error
+            raise ValueError("Cannot execute an empty query")
+        # The limit is passed as the $top_k parameter so that the query text,
+        # and with it Neo4j's cached plan, does not change with top_k
+        query, replaced = limit_pattern.subn(" LIMIT $top_k", query)
+        if not replaced and not limit_keyword_pattern.search(query):
+            query += " LIMIT $top_k"
+        return query
 
-
-                    if splitted_corrected[0] in selected_nodes and splitted_corrected[2] in selected_nodes:
-                        edge_results_filtered.append(res.values()[0])
-
-                # Relation property filtering
-                records, _, _ = driver.execute_query(rel_properties_query, database_=self.db_name)
-                edge_properties_results_filtered = [res.values()[0] for res in records]
-
-            schema = {
-                "nodes": selected_nodes,
-                "node_properties": node_results_filtered,
-                "edges": edge_results_filtered,
-                "edge_properties": edge_properties_results_filtered
-            }
-
-            if not os.path.isfile(file_path):
-                with open(file_path, "w") as fp:
-                    json.dump(schema, fp)
-
-
-            return schema
-
-    @validate_call
     def execute(self, query: str, top_k: int = 5):
+        query = self._limit_query(query)
+        top_k = int(top_k)
+        # Stream the result and only turn the first top_k records into dicts
+        with self._driver.session(**self._read_session_config) as session:
+            result = session.run(query, top_k=top_k)
+            results = [record.data() for record in result.fetch(top_k)]
+        return results
 
-        if "LIMIT" in query:
-            regex_pattern = r'\bLIMIT\s+\d+\b'
-            query = re.sub(regex_pattern, f" LIMIT {top_k}", query.strip().strip("\n"))
-        else:
-            query = query.strip().strip("\n") + f" LIMIT {top_k}"
-
-        with neo4j.GraphDatabase.driver(self.URI, auth=self.AUTH) as driver:
-            records, _, _ = driver.execute_query(query, database_=self.db_name, routing_="r")
-            results = [res.data() for index, res in enumerate(records) if top_k and index <= top_k]
+    async def execute_async(self, query: str, top_k: int = 5):
+        """
+        Same as `execute`, but awaits the database round-trip so that an
+        event loop can serve other requests in the meantime.
+        """
+        query = self._limit_query(query)
+        top_k = int(top_k)
+        if self._async_driver is None:
+            self._async_driver = neo4j.AsyncGraphDatabase.driver(self.URI, **self._driver_config)
+        async with self._async_driver.session(**self._read_session_config) as session:
+            result = await session.run(query, top_k=top_k)
+            results = [record.data() for record in await result.fetch(top_k)]
         return results
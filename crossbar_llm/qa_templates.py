@@ -89,6 +89,25 @@ CYPHER_GENERATION_PROMPT = PromptTemplate(
     template=CYPHER_GENERATION_TEMPLATE
 )
 
+def build_cypher_generation_prompt(schema: dict) -> PromptTemplate:
+    """
+    Renders the schema into CYPHER_GENERATION_TEMPLATE once, so that only the
+    question is left to fill in for every call.
+
+    Args:
+        schema: graph schema as returned by Neo4jGraphHelper.create_graph_schema_variables
+    """
+    rendered = CYPHER_GENERATION_TEMPLATE.format(node_types=schema["nodes"],
+                                                 node_properties=schema["node_properties"],
+                                                 edge_properties=schema["edge_properties"],
+                                                 edges=schema["edges"],
+                                                 question="{question}")
+    # Braces in the rendered schema and examples are literal text now, so
+    # escape all of them and restore the question placeholder, which is the
+    # last one in the template
+    head, _, tail = rendered.replace("{", "{{").replace("}", "}}").rpartition("{{question}}")
+    return PromptTemplate(input_variables=["question"], template=head + "{question}" + tail)
+
 CYPHER_OUTPUT_PARSER_TEMPLATE = """Task:Parse output of Cypher statement to natural language text based on
 given question in order to answer it.
 Instructions:
@@ -22,6 +22,14 @@ def initialize_logging():
 initialize_logging()
 
 
+def read_log_since(offset: int) -> str:
+    # Only read what was logged after `offset` rather than the whole log,
+    # which keeps growing for the lifetime of the session
+    with open(st.session_state.log_filename, 'rb') as file:
+        file.seek(offset)
+        return file.read().decode()
+
+
 def fix_markdown(text: str) -> str:
     return text.replace(":", "\:")
 
@@ -36,51 +44,51 @@ def run_query(question: str, llm_type, api_key=None) -> str:
     try:
         response = st.session_state.rp.run_for_query(question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
 
     return response
 
 
 def run_natural(query: str, question: str, llm_type, verbose_mode: bool, api_key=None) -> str:
+    log_offset = os.path.getsize(st.session_state.log_filename) if verbose_mode else 0
     logging.info("Processing question...")
 
     # Run the pipeline
     try:
         response, result = st.session_state.rp.execute_query(query=query, question=question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
     
     verbose_output = ""
     if verbose_mode:
-        with open(st.session_state.log_filename, 'r') as file:
-            verbose_output = file.read()
+        verbose_output = read_log_since(log_offset)
 
     return response, verbose_output, result
 
 
 def generate_and_run(question: str, llm_type, verbose_mode: bool, api_key=None) -> str:
+    log_offset = os.path.getsize(st.session_state.log_filename) if verbose_mode else 0
     logging.info("Processing question...")
 
     # Run the pipeline
     try:
         query = st.session_state.rp.run_for_query(question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
 
     # Run the pipeline
     try:
         response, result = st.session_state.rp.execute_query(query=query, question=question, model_name=llm_type, reset_llm_type=True, api_key=api_key)
     except Exception as e:
-        logging.error(f"Error in pipeline: {e}")
+        logging.error("Error in pipeline: %s", e)
         raise e
     
     verbose_output = ""
     if verbose_mode:
-        with open(st.session_state.log_filename, 'r') as file:
-            verbose_output = file.read()
+        verbose_output = read_log_since(log_offset)
 
     return response, verbose_output, result, query
 
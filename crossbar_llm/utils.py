@@ -1,10 +1,10 @@
-from timeit import default_timer as timer
+from time import perf_counter_ns
 
 def timer_func(func):
     def wrapper(*args, **kwargs):
-        t1 = timer()
+        t1 = perf_counter_ns()
         result = func(*args, **kwargs)
-        t2 = timer()
-        print(f'{func.__name__}() executed in {(t2-t1):.6f}s')
+        t2 = perf_counter_ns()
+        print(f'{func.__name__}() executed in {(t2-t1) / 1e9:.6f}s')
         return result
     return wrapper